@@ -1,11 +1,19 @@
 # Importación de librerías necesarias de Flask y Python
 from flask import Flask, request, jsonify, send_from_directory, redirect, make_response, send_file
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
+import re
+from datetime import date
+import hashlib
+from functools import wraps
 from dotenv import load_dotenv
 from services.auth_service import AuthService
 from services.gmail_service import GmailService
 from services.supabase_service import SupabaseService
+from services.download_budget_service import DownloadBudgetService, BudgetExceededError
+from services.admission_service import AdmissionService, AdmissionRejectedError
+from services.report_service import LedgerReportService, DIMENSIONES, REPORTE_MAX_MESES, REPORTE_ANIO_MINIMO
 
 # Cargar variables de entorno desde el archivo config.env para manejar secretos de forma segura
 load_dotenv('config.env')
@@ -13,6 +21,10 @@ load_dotenv('config.env')
 # Inicializar la aplicación Flask configurando la carpeta de archivos estáticos
 app = Flask(__name__, static_folder='static', static_url_path='')
 
+# En Render la app corre detrás de un proxy: tomar la IP real del cliente desde X-Forwarded-For
+# (la usa el control de admisión para identificar sesiones no verificadas). Usar 0 si no hay proxy.
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.environ.get('PROXY_FIX_X_FOR', 1)))
+
 # Configuración de CORS para permitir peticiones desde dominios específicos
 allowed_origins = [
     "http://localhost:5000",                   # Entorno de desarrollo local
@@ -30,6 +42,61 @@ CORS(app, resources={
 # Definir la URL del frontend para redirecciones, priorizando la variable de entorno
 FRONTEND_URL = os.environ.get('FRONTEND_URL', 'http://localhost:5000')
 
+# Presupuestos de bytes por descarga y por usuario (compartido por todas las peticiones del proceso)
+download_budget = DownloadBudgetService()
+
+# Control de admisión para las rutas costosas (concurrencia por usuario y cola justa)
+admission = AdmissionService()
+
+# Reportes contables de DTE con caché de los meses ya calculados
+ledger_reports = LedgerReportService(
+    SupabaseService(),
+    cache_ttl_seconds=int(os.environ.get('REPORT_CACHE_TTL_SECONDS', 3600))
+)
+
+def token_digest(access_token):
+    """
+    Calcula un identificador del token de sesión sin guardar el token en memoria.
+    """
+    return hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+
+def get_verified_user_info(access_token):
+    """
+    Obtiene el perfil del usuario desde Google y recuerda el token como verificado
+    para que el control de admisión pueda identificar al usuario por su email.
+    """
+    user_info = AuthService().get_user_info(access_token)
+    if user_info and user_info.get('email'):
+        admission.remember_identity(token_digest(access_token), user_info['email'])
+    return user_info
+
+def admission_required(f):
+    """
+    Decorador que hace esperar la petición en la cola de admisión antes de ejecutarla.
+    Si la cola está llena responde 429 con la cabecera Retry-After.
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        access_token = request.cookies.get('gmail_token')
+        # Sin sesión la ruta responde 401 de inmediato, no necesita turno
+        if not access_token:
+            return f(*args, **kwargs)
+
+        # Identificar al usuario sin consultar a Google (la consulta también es costosa):
+        # si el token ya fue verificado se usa su email; si no, la IP del cliente, para que
+        # rotar cookies inventadas no cuente como usuarios distintos
+        user_email = admission.known_identity(token_digest(access_token))
+        user_key = f"user:{user_email}" if user_email else f"ip:{request.remote_addr}"
+        try:
+            with admission.slot(user_key):
+                return f(*args, **kwargs)
+        except AdmissionRejectedError as e:
+            print(f"Petición rechazada por control de admisión en {request.path}: {str(e)}")
+            response = jsonify({'error': str(e)})
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, 429
+    return wrapper
+
 # Ruta para servir la página principal del frontend
 @app.route('/')
 def serve_frontend():
@@ -41,6 +108,14 @@ def serve_frontend():
 def ping():
     return jsonify({'status': 'ok', 'message': 'pong'})
 
+# Ruta para consultar el estado de la cola de admisión (profundidad y tiempos de espera)
+@app.route('/api/admission-stats')
+def admission_stats():
+    stats = admission.stats()
+    # Cada worker de gunicorn tiene su propia cola; se incluye el PID para distinguirlos
+    stats['pid'] = os.getpid()
+    return jsonify(stats)
+
 # Ruta para iniciar el proceso de autenticación con Google
 @app.route('/auth/google', methods=['GET'])
 def google_auth():
@@ -103,9 +178,8 @@ def check_session():
     token = request.cookies.get('gmail_token')
     if token:
         try:
-            auth_service = AuthService()
             # Obtener información del perfil del usuario usando el token
-            user_info = auth_service.get_user_info(token)
+            user_info = get_verified_user_info(token)
             if user_info and 'email' in user_info:
                 return jsonify({
                     'authenticated': True,
@@ -120,6 +194,7 @@ def check_session():
 
 # Ruta para buscar correos electrónicos que contengan facturas
 @app.route('/api/search', methods=['POST'])
+@admission_required
 def search_emails():
     try:
         # Obtener el token de acceso de las cookies
@@ -142,8 +217,7 @@ def search_emails():
         
         # --- NUEVO: MARCAR SI YA FUERON DESCARGADOS ---
         supabase_service = SupabaseService()
-        auth_service = AuthService()
-        user_info = auth_service.get_user_info(access_token)
+        user_info = get_verified_user_info(access_token)
         user_email = user_info.get('email', 'anónimo')
         
         user_history = supabase_service.get_user_history(user_email)
@@ -159,8 +233,18 @@ def search_emails():
             else:
                 email['downloaded'] = False
 
-        # Retornar la lista de correos encontrados
-        return jsonify({'success': True, 'emails': emails, 'total': len(emails)})
+        # Retornar la lista de correos encontrados junto al tamaño total y los límites de descarga
+        return jsonify({
+            'success': True,
+            'emails': emails,
+            'total': len(emails),
+            'total_bytes': download_budget.estimate_bytes(emails),
+            'limits': {
+                'max_request_bytes': download_budget.max_request_bytes,
+                'max_user_bytes': download_budget.max_user_bytes,
+                'used_user_bytes': download_budget.used_bytes(user_email)
+            }
+        })
         
     except Exception as e:
         print(f"Error búsqueda: {str(e)}")
@@ -171,6 +255,7 @@ def search_emails():
 
 # Ruta para descargar múltiples adjuntos en un archivo comprimido ZIP
 @app.route('/api/download-batch', methods=['POST'])
+@admission_required
 def download_batch():
     try:
         # Obtener el token de acceso de las cookies
@@ -184,10 +269,74 @@ def download_batch():
         if not selected_emails:
             return jsonify({'error': 'No se seleccionaron emails'}), 400
 
+        # Obtener el email del usuario antes de trabajar para aplicar su presupuesto
+        # Sin email no se puede asignar un presupuesto propio, así que la sesión se considera inválida
+        user_info = get_verified_user_info(access_token) or {}
+        user_email = user_info.get('email')
+        if not user_email:
+            return jsonify({'error': 'Sesión no válida'}), 401
+
+        # --- PRESUPUESTO: estimar el tamaño del lote antes de descargar nada ---
+        # La estimación depende de los tamaños enviados por el cliente: sin tamaño válido no se acepta
+        untrusted = download_budget.untrusted_attachments(selected_emails)
+        if untrusted:
+            return jsonify({
+                'error': 'Hay adjuntos sin tamaño válido, vuelve a realizar la búsqueda',
+                'attachments': untrusted
+            }), 400
+
+        estimated_bytes = download_budget.estimate_bytes(selected_emails)
+
+        # Una selección mayor que el presupuesto completo del usuario nunca podrá descargarse esperando
+        if estimated_bytes > download_budget.max_user_bytes:
+            return jsonify({
+                'error': 'La selección supera el presupuesto de descarga por usuario, selecciona menos facturas',
+                'estimated_bytes': estimated_bytes,
+                'max_user_bytes': download_budget.max_user_bytes
+            }), 413
+
+        # Verificar que el usuario tenga presupuesto disponible para toda la selección
+        retry_after = download_budget.check_user_budget(user_email, estimated_bytes)
+        if retry_after is not None:
+            response = jsonify({
+                'error': 'Se alcanzó el límite de descarga por usuario, intenta más tarde',
+                'estimated_bytes': estimated_bytes,
+                'max_user_bytes': download_budget.max_user_bytes
+            })
+            response.headers['Retry-After'] = str(retry_after)
+            return response, 429
+
+        # Los correos que por sí solos no caben en un ZIP se rechazan antes de empezar
+        oversized = download_budget.oversized_emails(selected_emails)
+        if oversized:
+            return jsonify({
+                'error': f'{len(oversized)} correo(s) superan por sí solos el límite por descarga, quítalos de la selección',
+                'max_request_bytes': download_budget.max_request_bytes,
+                'oversized': oversized
+            }), 413
+
+        # Si la selección no cabe en un solo ZIP, proponer la división en volúmenes
+        if estimated_bytes > download_budget.max_request_bytes:
+            return jsonify({
+                'error': 'La selección supera el límite por descarga y debe dividirse en volúmenes',
+                'estimated_bytes': estimated_bytes,
+                'max_request_bytes': download_budget.max_request_bytes,
+                'volumes': download_budget.plan_volumes(selected_emails)
+            }), 413
+
         # Inicializar el servicio de Gmail
         gmail_service = GmailService(access_token)
         # Generar el archivo ZIP y extraer metadatos de los JSON de DTE
-        zip_buffer, dte_metadata = gmail_service.download_attachments_as_zip(selected_emails)
+        try:
+            zip_buffer, dte_metadata, downloaded_bytes = gmail_service.download_attachments_as_zip(
+                selected_emails, max_bytes=download_budget.max_request_bytes
+            )
+        except BudgetExceededError as e:
+            # Los bytes ya descargados de Gmail también se cobran, aunque el ZIP no se entregue
+            download_budget.charge(user_email, e.downloaded_bytes)
+            raise
+        # Descontar del presupuesto del usuario los bytes realmente descargados
+        download_budget.charge(user_email, downloaded_bytes)
         
         # Enviar el archivo ZIP generado al usuario
         response = send_file(
@@ -199,17 +348,15 @@ def download_batch():
         
         # --- NUEVO: ENVIAR METADATOS DTE EN LOS HEADERS ---
         # Convertimos la lista de metadatos a JSON para que el frontend pueda leerla
+        # (los totales contables no se envían en el header para no agrandarlo)
         import json
-        response.headers['X-DTE-Metadata'] = json.dumps(dte_metadata)
+        response.headers['X-DTE-Metadata'] = json.dumps([
+            {k: v for k, v in m.items() if k != 'ledger'} for m in dte_metadata
+        ])
         # Exponemos el header para que JavaScript pueda acceder a él (CORS)
         response.headers['Access-Control-Expose-Headers'] = 'X-DTE-Metadata'
         # --- NUEVO: GUARDAR EN SUPABASE DESDE EL BACKEND ---
         try:
-            # Obtener el email del usuario para el registro
-            auth_service = AuthService()
-            user_info = auth_service.get_user_info(access_token)
-            user_email = user_info.get('email', 'anónimo')
-
             # Preparar los datos para el historial
             supabase_service = SupabaseService()
             history_rows = []
@@ -235,15 +382,98 @@ def download_batch():
 
             if history_rows:
                 supabase_service.save_history(history_rows)
+
+            # Guardar los totales de cada DTE para los reportes contables
+            # Un mismo DTE puede llegar en varios correos (ej. reenviados); PostgREST rechaza todo el
+            # upsert si un código se repite en el lote, así que se deja solo la última aparición
+            dte_by_code = {
+                m['codigo_generacion']: {'usuario_email': user_email, 'codigo_generacion': m['codigo_generacion'], **m['ledger']}
+                for m in dte_metadata if m.get('ledger')
+            }
+            dte_rows = list(dte_by_code.values())
+            if dte_rows and supabase_service.save_dte_documents(dte_rows):
+                # Los meses con nuevos DTE deben recalcularse en el próximo reporte
+                ledger_reports.invalidate(user_email, {(r['fecha_emision'] or '')[:7] for r in dte_rows})
         except Exception as se:
             print(f"Error al registrar historial en backend: {str(se)}")
 
         return response
         
+    except BudgetExceededError as e:
+        # El tamaño real superó el límite (los tamaños estimados no eran fiables)
+        print(f"Límite de descarga superado: {str(e)}")
+        return jsonify({'error': str(e)}), 413
     except Exception as e:
         print(f"Error descarga: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+# Ruta para generar el reporte contable de DTE (totales por mes, emisor y tipo de documento)
+@app.route('/api/reports/ledger', methods=['GET'])
+@admission_required
+def ledger_report():
+    try:
+        # Obtener el token de acceso de las cookies
+        access_token = request.cookies.get('gmail_token')
+        if not access_token:
+            return jsonify({'error': 'Sesión no válida'}), 401
+
+        # Validar el rango de meses (formato YYYY-MM)
+        start_month = request.args.get('start', '')
+        end_month = request.args.get('end', '') or start_month
+        month_pattern = re.compile(r'^\d{4}-(0[1-9]|1[0-2])$')
+        if not month_pattern.match(start_month) or not month_pattern.match(end_month):
+            return jsonify({'error': 'Los parámetros start y end deben tener el formato YYYY-MM'}), 400
+        if start_month > end_month:
+            return jsonify({'error': 'El mes inicial no puede ser posterior al mes final'}), 400
+
+        # Acotar años y cantidad de meses: cada mes pedido ocupa una entrada en la caché
+        start_year, start_m = map(int, start_month.split('-'))
+        end_year, end_m = map(int, end_month.split('-'))
+        max_year = date.today().year + 1
+        if start_year < REPORTE_ANIO_MINIMO or end_year > max_year:
+            return jsonify({'error': f'Los años deben estar entre {REPORTE_ANIO_MINIMO} y {max_year}'}), 400
+        if (end_year - start_year) * 12 + (end_m - start_m) + 1 > REPORTE_MAX_MESES:
+            return jsonify({'error': f'El reporte admite como máximo {REPORTE_MAX_MESES} meses'}), 400
+
+        # Dimensiones de agrupación (por defecto: mes, emisor y tipo de documento)
+        group_by = tuple(g for g in request.args.get('group_by', ','.join(DIMENSIONES)).split(',') if g)
+        if not group_by or any(g not in DIMENSIONES for g in group_by):
+            return jsonify({'error': f"group_by solo admite: {', '.join(DIMENSIONES)}"}), 400
+
+        report_format = request.args.get('format', 'csv').lower()
+        if report_format not in ('csv', 'xlsx', 'json'):
+            return jsonify({'error': 'Formato no soportado (csv, xlsx o json)'}), 400
+
+        # Obtener el email del usuario para consultar solo sus DTE
+        user_info = get_verified_user_info(access_token) or {}
+        user_email = user_info.get('email')
+        if not user_email:
+            return jsonify({'error': 'Sesión no válida'}), 401
+
+        rows = ledger_reports.build_report(user_email, start_month, end_month, group_by)
+
+        if report_format == 'json':
+            return jsonify({'success': True, 'rows': rows, 'total': len(rows)})
+
+        filename = f"reporte_dte_{start_month}_{end_month}.{report_format}"
+        if report_format == 'xlsx':
+            return send_file(
+                ledger_reports.to_xlsx(rows, group_by),
+                as_attachment=True,
+                download_name=filename,
+                mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            )
+        return send_file(
+            ledger_reports.to_csv(rows, group_by),
+            as_attachment=True,
+            download_name=filename,
+            mimetype='text/csv'
+        )
+
+    except Exception as e:
+        print(f"Error reporte: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 # Punto de entrada principal para ejecutar la aplicación
 if __name__ == '__main__':
     # Ejecutar la aplicación en el puerto configurado por el entorno o el 5000 por defecto
@@ -0,0 +1,256 @@
+# Importación de librerías para configuración, tiempos y control de concurrencia entre hilos
+import os
+import time
+import threading
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+
+
+class AdmissionRejectedError(Exception):
+    """
+    Se lanza cuando una petición no puede ser admitida (cola llena o espera agotada).
+    Incluye los segundos sugeridos para reintentar (cabecera Retry-After).
+    """
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Ticket:
+    """
+    Turno de espera de una petición encolada.
+    """
+    def __init__(self, user_key):
+        self.user_key = user_key
+        self.enqueued_at = time.monotonic()
+        self.granted = threading.Event()
+
+
+class AdmissionService:
+    """
+    Control de admisión para las rutas costosas (búsqueda y descarga).
+    Limita las peticiones activas totales y por usuario, mantiene una cola de espera acotada
+    y reparte los turnos libres en orden round-robin entre usuarios para que nadie acapare los hilos.
+    """
+    def __init__(self):
+        # Hilos por worker de gunicorn (debe coincidir con --threads del Dockerfile)
+        self.threads = int(os.environ.get('GUNICORN_THREADS', 16))
+        # Hilos que nunca se ocupan con rutas costosas, para que ping, sesión y estadísticas respondan
+        self.reserved_threads = int(os.environ.get('ADMISSION_RESERVED_THREADS', 4))
+        # Cada petición activa o en cola ocupa un hilo: ambas deben caber en los hilos no reservados
+        available = self.threads - self.reserved_threads
+        if available < 2 or self.reserved_threads < 1:
+            raise ValueError(
+                f"GUNICORN_THREADS={self.threads} y ADMISSION_RESERVED_THREADS={self.reserved_threads} "
+                "no dejan hilos para las rutas costosas y las livianas"
+            )
+
+        # Máximo de peticiones costosas ejecutándose a la vez en este proceso (por defecto, un tercio)
+        self.max_active = int(os.environ.get('ADMISSION_MAX_ACTIVE', max(1, available // 3)))
+        # Máximo de peticiones costosas activas por usuario
+        self.max_active_per_user = int(os.environ.get('ADMISSION_MAX_ACTIVE_PER_USER', 1))
+        # Tamaño máximo de la cola de espera (total y por usuario); por defecto, el resto de hilos disponibles
+        self.max_queue = int(os.environ.get('ADMISSION_MAX_QUEUE', available - self.max_active))
+        self.max_queue_per_user = int(os.environ.get('ADMISSION_MAX_QUEUE_PER_USER', 2))
+        # Tiempo máximo que una petición puede esperar en cola antes de rechazarse (segundos)
+        self.max_wait_seconds = float(os.environ.get('ADMISSION_MAX_WAIT_SECONDS', 30))
+
+        # Si las peticiones activas más las encoladas ocupan todos los hilos, las nuevas peticiones
+        # ni siquiera llegarían a acquire() y no recibirían el 429 rápido
+        if self.max_active + self.max_queue > available:
+            raise ValueError(
+                f"ADMISSION_MAX_ACTIVE ({self.max_active}) + ADMISSION_MAX_QUEUE ({self.max_queue}) "
+                f"debe ser como máximo GUNICORN_THREADS - ADMISSION_RESERVED_THREADS ({available})"
+            )
+
+        # Usuarios verificados con Google: hash del token -> (email, timestamp)
+        self.identity_ttl_seconds = 3600  # Igual que la duración de la cookie de sesión
+        self._identities = OrderedDict()
+        self._max_identities = 10000
+
+        self._lock = threading.Lock()
+        self._active_total = 0
+        self._active_per_user = {}
+        # Colas por usuario en orden de turno: user_key -> deque de tickets
+        self._queues = OrderedDict()
+        self._waiting = 0
+
+        # Métricas para dimensionar la cantidad de workers
+        self._admitted = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._service_avg = 1.0  # Promedio móvil de la duración de las peticiones (segundos)
+
+    def remember_identity(self, token_digest, user_email):
+        """
+        Registra que un token fue verificado con Google y a qué usuario pertenece.
+        """
+        with self._lock:
+            self._identities.pop(token_digest, None)
+            self._identities[token_digest] = (user_email, time.monotonic())
+            # Mantener acotado el registro descartando los más antiguos
+            while len(self._identities) > self._max_identities:
+                self._identities.popitem(last=False)
+
+    def known_identity(self, token_digest):
+        """
+        Retorna el email asociado a un token ya verificado, o None si no se conoce o expiró.
+        """
+        with self._lock:
+            entry = self._identities.get(token_digest)
+            if not entry:
+                return None
+            if time.monotonic() - entry[1] > self.identity_ttl_seconds:
+                del self._identities[token_digest]
+                return None
+            return entry[0]
+
+    def _can_run(self, user_key):
+        """
+        Indica si hay un espacio libre para el usuario. Debe llamarse con el candado adquirido.
+        """
+        return (self._active_total < self.max_active
+                and self._active_per_user.get(user_key, 0) < self.max_active_per_user)
+
+    def _start(self, user_key):
+        """
+        Marca una petición como activa. Debe llamarse con el candado adquirido.
+        """
+        self._active_total += 1
+        self._active_per_user[user_key] = self._active_per_user.get(user_key, 0) + 1
+
+    def _retry_after(self):
+        """
+        Estima en cuántos segundos se liberará la cola. Debe llamarse con el candado adquirido.
+        """
+        rounds = (self._waiting + self._active_total) / max(self.max_active, 1)
+        return max(1, int(rounds * self._service_avg + 0.5))
+
+    def _dispatch(self):
+        """
+        Entrega los espacios libres a los usuarios en espera, uno por usuario en cada vuelta.
+        Debe llamarse con el candado adquirido.
+        """
+        progressed = True
+        while self._queues and self._active_total < self.max_active and progressed:
+            progressed = False
+            for user_key in list(self._queues):
+                if self._active_total >= self.max_active:
+                    break
+                if not self._can_run(user_key):
+                    continue
+                queue = self._queues[user_key]
+                ticket = queue.popleft()
+                self._waiting -= 1
+                # El usuario atendido pasa al final de la ronda
+                del self._queues[user_key]
+                if queue:
+                    self._queues[user_key] = queue
+                self._start(user_key)
+                ticket.granted.set()
+                progressed = True
+
+    def _remove_ticket(self, ticket):
+        """
+        Retira de la cola un ticket que agotó su espera. Debe llamarse con el candado adquirido.
+        """
+        queue = self._queues.get(ticket.user_key)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            self._waiting -= 1
+            if not queue:
+                del self._queues[ticket.user_key]
+
+    def acquire(self, user_key):
+        """
+        Espera un turno para el usuario. Lanza AdmissionRejectedError si la cola está llena
+        o si la espera supera el máximo configurado.
+        """
+        with self._lock:
+            # Solo se entra directo si nadie espera, para respetar el orden justo de la cola
+            if not self._queues and self._can_run(user_key):
+                self._start(user_key)
+                self._admitted += 1
+                return 0.0
+
+            user_queue = self._queues.get(user_key)
+            if self._waiting >= self.max_queue or (user_queue and len(user_queue) >= self.max_queue_per_user):
+                self._rejected += 1
+                raise AdmissionRejectedError('Servidor ocupado, intenta de nuevo en unos segundos', self._retry_after())
+
+            ticket = _Ticket(user_key)
+            self._queues.setdefault(user_key, deque()).append(ticket)
+            self._waiting += 1
+            self._dispatch()
+
+        granted = ticket.granted.wait(self.max_wait_seconds)
+
+        with self._lock:
+            # El turno pudo concederse justo cuando vencía la espera
+            if not granted and not ticket.granted.is_set():
+                self._remove_ticket(ticket)
+                self._timed_out += 1
+                self._rejected += 1
+                raise AdmissionRejectedError('Tiempo de espera agotado, intenta de nuevo', self._retry_after())
+
+            waited = time.monotonic() - ticket.enqueued_at
+            self._admitted += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+            return waited
+
+    def release(self, user_key, duration=None):
+        """
+        Libera el turno del usuario y entrega los espacios libres a la cola.
+        """
+        with self._lock:
+            self._active_total -= 1
+            remaining = self._active_per_user.get(user_key, 1) - 1
+            if remaining > 0:
+                self._active_per_user[user_key] = remaining
+            else:
+                self._active_per_user.pop(user_key, None)
+            if duration is not None:
+                self._service_avg = 0.8 * self._service_avg + 0.2 * duration
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, user_key):
+        """
+        Ejecuta un bloque de código ocupando un turno del usuario.
+        """
+        self.acquire(user_key)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(user_key, time.monotonic() - started)
+
+    def stats(self):
+        """
+        Retorna las métricas de la cola para dimensionar la cantidad de workers.
+        """
+        with self._lock:
+            return {
+                'active': self._active_total,
+                'active_users': len(self._active_per_user),
+                'queue_depth': self._waiting,
+                'queued_users': len(self._queues),
+                'admitted': self._admitted,
+                'rejected': self._rejected,
+                'timed_out': self._timed_out,
+                'avg_wait_seconds': round(self._wait_total / self._admitted, 3) if self._admitted else 0.0,
+                'max_wait_seconds': round(self._wait_max, 3),
+                'avg_service_seconds': round(self._service_avg, 3),
+                'limits': {
+                    'threads': self.threads,
+                    'reserved_threads': self.reserved_threads,
+                    'max_active': self.max_active,
+                    'max_active_per_user': self.max_active_per_user,
+                    'max_queue': self.max_queue,
+                    'max_queue_per_user': self.max_queue_per_user,
+                    'max_wait_seconds': self.max_wait_seconds
+                }
+            }
@@ -0,0 +1,212 @@
+# Importación de librerías para configuración, fechas y control de concurrencia
+import os
+import time
+import threading
+from collections import deque
+from datetime import datetime, timezone
+
+
+class BudgetExceededError(Exception):
+    """
+    Se lanza cuando una descarga supera el presupuesto de bytes permitido.
+    Incluye los bytes que ya se habían descargado para poder cobrarlos al usuario.
+    """
+    def __init__(self, message, downloaded_bytes=0):
+        super().__init__(message)
+        self.downloaded_bytes = downloaded_bytes
+
+
+class DownloadBudgetService:
+    """
+    Servicio encargado de estimar el tamaño de un lote de descarga y de aplicar
+    los presupuestos de bytes por petición y por usuario antes de generar el ZIP.
+    Si la selección es demasiado grande, propone dividirla en varios volúmenes.
+    """
+    def __init__(self):
+        # Máximo de bytes (sin comprimir) que se permiten en un solo ZIP generado en memoria
+        self.max_request_bytes = int(os.environ.get('DOWNLOAD_MAX_REQUEST_BYTES', 50 * 1024 * 1024))
+        # Máximo de bytes que un usuario puede descargar dentro de la ventana de tiempo
+        self.max_user_bytes = int(os.environ.get('DOWNLOAD_MAX_USER_BYTES', 500 * 1024 * 1024))
+        # Duración de la ventana de tiempo para el presupuesto por usuario (en segundos)
+        self.user_window_seconds = int(os.environ.get('DOWNLOAD_USER_WINDOW_SECONDS', 3600))
+
+        # Registro de descargas por usuario: email -> deque de (timestamp, bytes)
+        # Nota: el registro vive en memoria del proceso, cada worker de gunicorn lleva el suyo
+        self._usage = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def estimate_email_bytes(email):
+        """
+        Suma el tamaño declarado de todos los adjuntos de un correo.
+        """
+        return sum(int(att.get('size') or 0) for att in email.get('attachments', []))
+
+    @staticmethod
+    def untrusted_attachments(selected_emails):
+        """
+        Retorna los nombres de los adjuntos sin un tamaño positivo declarado.
+        Gmail siempre informa el tamaño, así que un valor ausente o cero indica una selección manipulada.
+        """
+        untrusted = []
+        for email in selected_emails:
+            for att in email.get('attachments', []):
+                size = att.get('size')
+                if isinstance(size, bool) or not isinstance(size, int) or size <= 0:
+                    untrusted.append(att.get('filename', ''))
+        return untrusted
+
+    def estimate_bytes(self, selected_emails):
+        """
+        Estima el tamaño total (sin comprimir) del ZIP a partir de los tamaños de los adjuntos.
+        """
+        return sum(self.estimate_email_bytes(email) for email in selected_emails)
+
+    def _purge(self, user_email, now):
+        """
+        Elimina del registro las descargas que ya salieron de la ventana de tiempo.
+        Debe llamarse con el candado adquirido.
+        """
+        entries = self._usage.get(user_email)
+        if not entries:
+            return
+        while entries and entries[0][0] <= now - self.user_window_seconds:
+            entries.popleft()
+        if not entries:
+            del self._usage[user_email]
+
+    def used_bytes(self, user_email):
+        """
+        Retorna los bytes descargados por el usuario dentro de la ventana actual.
+        """
+        with self._lock:
+            self._purge(user_email, time.time())
+            return sum(b for _, b in self._usage.get(user_email, ()))
+
+    def check_user_budget(self, user_email, requested_bytes):
+        """
+        Verifica si el usuario puede descargar la cantidad de bytes solicitada.
+        Retorna None si hay presupuesto disponible, o los segundos que debe esperar si no.
+        """
+        with self._lock:
+            now = time.time()
+            self._purge(user_email, now)
+            entries = self._usage.get(user_email, deque())
+            used = sum(b for _, b in entries)
+            if used + requested_bytes <= self.max_user_bytes:
+                return None
+
+            # Una petición mayor que el presupuesto completo nunca podrá cumplirse esperando
+            if requested_bytes > self.max_user_bytes:
+                return self.user_window_seconds
+
+            # Calcular cuándo se libera suficiente espacio en la ventana
+            freed = 0
+            for ts, b in entries:
+                freed += b
+                if used - freed + requested_bytes <= self.max_user_bytes:
+                    return max(1, int(ts + self.user_window_seconds - now) + 1)
+            return self.user_window_seconds
+
+    def charge(self, user_email, used_bytes):
+        """
+        Registra los bytes efectivamente descargados por el usuario.
+        """
+        if used_bytes <= 0:
+            return
+        with self._lock:
+            self._usage.setdefault(user_email, deque()).append((time.time(), used_bytes))
+
+    @staticmethod
+    def _email_month(email):
+        """
+        Obtiene el mes (YYYY-MM) de un correo a partir de su fecha interna de Gmail.
+        """
+        try:
+            timestamp_ms = int(email.get('timestamp') or 0)
+        except (TypeError, ValueError):
+            timestamp_ms = 0
+        if not timestamp_ms:
+            return 'sin-fecha'
+        return datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc).strftime('%Y-%m')
+
+    def oversized_emails(self, selected_emails, max_bytes=None):
+        """
+        Retorna los correos que por sí solos superan el límite por petición (no caben en ningún volumen).
+        """
+        max_bytes = max_bytes or self.max_request_bytes
+        return [
+            {'id': email['id'], 'subject': email.get('subject'), 'bytes': self.estimate_email_bytes(email)}
+            for email in selected_emails
+            if self.estimate_email_bytes(email) > max_bytes
+        ]
+
+    def plan_volumes(self, selected_emails, max_bytes=None):
+        """
+        Divide una selección demasiado grande en volúmenes que respeten el límite por petición.
+        Se agrupan meses completos mientras quepan; si un mes no cabe solo, se parte por tamaño.
+        Retorna una lista de volúmenes con su etiqueta, los IDs de correo y los bytes estimados.
+        Lanza BudgetExceededError si algún correo por sí solo supera el límite.
+        """
+        max_bytes = max_bytes or self.max_request_bytes
+        if self.oversized_emails(selected_emails, max_bytes):
+            raise BudgetExceededError(f"Hay correos que por sí solos superan el límite de {max_bytes} bytes")
+
+        # Agrupar los correos por mes manteniendo un orden cronológico
+        months = {}
+        for email in selected_emails:
+            months.setdefault(self._email_month(email), []).append(email)
+
+        volumes = []
+        current = {'months': [], 'email_ids': [], 'bytes': 0}
+
+        def close_current():
+            if current['email_ids']:
+                volumes.append(dict(current))
+            current.update({'months': [], 'email_ids': [], 'bytes': 0})
+
+        for month in sorted(months):
+            emails = months[month]
+            month_bytes = sum(self.estimate_email_bytes(e) for e in emails)
+
+            # El mes completo cabe en el volumen actual: se agrega tal cual
+            if current['bytes'] + month_bytes <= max_bytes:
+                current['months'].append(month)
+                current['email_ids'].extend(e['id'] for e in emails)
+                current['bytes'] += month_bytes
+                continue
+
+            close_current()
+
+            # El mes cabe en un volumen nuevo
+            if month_bytes <= max_bytes:
+                current.update({'months': [month], 'email_ids': [e['id'] for e in emails], 'bytes': month_bytes})
+                continue
+
+            # El mes no cabe solo: se parte por tamaño en varias partes
+            part = 1
+            for email in emails:
+                email_bytes = self.estimate_email_bytes(email)
+                if current['email_ids'] and current['bytes'] + email_bytes > max_bytes:
+                    current['months'] = [f"{month}_parte{part}"]
+                    close_current()
+                    part += 1
+                current['email_ids'].append(email['id'])
+                current['bytes'] += email_bytes
+            current['months'] = [f"{month}_parte{part}"]
+            close_current()
+
+        close_current()
+
+        # Construir las etiquetas legibles de cada volumen (ej. "2024-01" o "2024-01_a_2024-03")
+        result = []
+        for index, volume in enumerate(volumes, start=1):
+            first, last = volume['months'][0], volume['months'][-1]
+            label = first if first == last else f"{first}_a_{last}"
+            result.append({
+                'index': index,
+                'label': label,
+                'email_ids': volume['email_ids'],
+                'bytes': volume['bytes']
+            })
+        return result
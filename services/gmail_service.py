@@ -5,6 +5,8 @@ import zipfile
 import io
 from googleapiclient.discovery import build
 from google.oauth2.credentials import Credentials
+from services.download_budget_service import BudgetExceededError
+from services.report_service import extract_dte_ledger
 
 class GmailService:
     """
@@ -116,8 +118,10 @@ class GmailService:
             'subject': subject,
             'from': sender,
             'date': date[:16] if date else 'Desconocida',
+            'timestamp': int(message.get('internalDate', 0)), # Fecha interna de Gmail en milisegundos
             'snippet': message.get('snippet', '')[:100] + '...', # Fragmento del texto del correo
-            'attachments': attachments 
+            'attachments': attachments,
+            'size': sum(att['size'] for att in attachments) # Tamaño total de los adjuntos en bytes
         }
 
     def _find_attachments_recursive(self, msg_id, parts):
@@ -137,7 +141,8 @@ class GmailService:
                     attachments.append({
                         'filename': filename,
                         'mimeType': part.get('mimeType'),
-                        'attachmentId': part['body']['attachmentId'] # Necesario para la descarga posterior
+                        'attachmentId': part['body']['attachmentId'], # Necesario para la descarga posterior
+                        'size': int(part['body'].get('size', 0)) # Tamaño en bytes para estimar el ZIP
                     })
             
             # Si la parte contiene sub-partes, realizar la búsqueda en ellas (recursión)
@@ -146,15 +151,19 @@ class GmailService:
                 
         return attachments
 
-    def download_attachments_as_zip(self, selected_emails):
+    def download_attachments_as_zip(self, selected_emails, max_bytes=None):
         """
         Descarga los adjuntos y extrae metadatos si son JSON de DTE.
         Implementa lógica de agrupación y renombrado inteligente basado en el código de generación del DTE.
+        Si se indica max_bytes, se detiene en cuanto los datos descargados superan ese límite.
+        Retorna el ZIP, los metadatos y el total de bytes descargados.
         """
         import json  # Importación local para asegurar disponibilidad
         
         zip_buffer = io.BytesIO()
         all_extracted_metadata = []
+        # Total de bytes descargados (sin comprimir) para controlar el presupuesto real
+        total_bytes = 0
         
         with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
              # Set para manejar colisiones de nombres dentro del ZIP
@@ -186,11 +195,20 @@ class GmailService:
                                 nombre_factura_oficial = f"DTE_{codigo}"
                                 emisor_dte = dict_data.get('emisor', {}).get('nombre')
                                 
-                                # Guardamos los metadatos para el historial
+                                # Los totales para reportes se extraen aparte: un resumen mal formado
+                                # no debe impedir que el correo quede registrado en el historial
+                                try:
+                                    ledger = extract_dte_ledger(dict_data)
+                                except Exception as e:
+                                    print(f"Error extrayendo totales del DTE {codigo}: {str(e)}")
+                                    ledger = None
+
+                                # Guardamos los metadatos para el historial y los totales para los reportes
                                 all_extracted_metadata.append({
                                     'codigo_generacion': codigo,
                                     'emisor_nombre': emisor_dte,
-                                    'filename': att['filename'] # Guardamos referencia al nombre original
+                                    'filename': att['filename'], # Guardamos referencia al nombre original
+                                    'ledger': ledger
                                 })
                                 break # Ya encontramos el identificador principal, no es necesario seguir buscando en otros JSON
                         except Exception as e:
@@ -225,15 +243,25 @@ class GmailService:
                             userId='me', messageId=msg_id, id=att_id
                         ).execute()
                         file_data = base64.urlsafe_b64decode(att_data_raw['data'].encode('UTF-8'))
+
+                        # Los tamaños enviados por el cliente son solo una estimación: se verifica el real
+                        total_bytes += len(file_data)
+                        if max_bytes and total_bytes > max_bytes:
+                            raise BudgetExceededError(
+                                f"El lote supera el límite de {max_bytes} bytes por descarga",
+                                downloaded_bytes=total_bytes
+                            )
                         
                         # Escribir en el archivo ZIP con el nombre final determinado
                         zip_file.writestr(nombre_final, file_data)
                         
+                    except BudgetExceededError:
+                        raise
                     except Exception as e:
                         print(f"Error descargando/guardando el archivo {att.get('filename')}: {str(e)}")
                         # Opcional: Escribir un archivo de error en el zip
                         zip_file.writestr(f"ERROR_{att.get('filename')}.txt", str(e))
 
         zip_buffer.seek(0)
-        return zip_buffer, all_extracted_metadata
+        return zip_buffer, all_extracted_metadata, total_bytes
 
@@ -0,0 +1,350 @@
+# Importación de librerías para fechas, archivos en memoria y control de concurrencia
+import io
+import csv
+import time
+import threading
+from datetime import date, datetime, timezone
+
+# Nombres legibles de los tipos de DTE definidos por el Ministerio de Hacienda
+TIPOS_DTE = {
+    '01': 'Factura',
+    '03': 'Comprobante de crédito fiscal',
+    '04': 'Nota de remisión',
+    '05': 'Nota de crédito',
+    '06': 'Nota de débito',
+    '07': 'Comprobante de retención',
+    '08': 'Comprobante de liquidación',
+    '09': 'Documento contable de liquidación',
+    '11': 'Factura de exportación',
+    '14': 'Factura de sujeto excluido',
+    '15': 'Comprobante de donación'
+}
+
+# Tipos de DTE sin IVA: exportación, sujeto excluido y donación
+TIPOS_SIN_IVA = ('11', '14', '15')
+
+# Dimensiones por las que se puede agrupar el reporte
+DIMENSIONES = ('mes', 'emisor', 'tipo_dte')
+
+# Límites del rango de un reporte (validados en la ruta antes de calcular)
+REPORTE_MAX_MESES = 36
+REPORTE_ANIO_MINIMO = 2000
+
+# Tipos de DTE que se cuentan pero no suman montos: la nota de remisión es un documento de
+# traslado de mercadería y el comprobante de retención solo aporta IVA retenido
+TIPOS_SIN_MONTOS = ('04', '07')
+
+# Montos que se suman en el reporte (en ese orden se guardan en la caché)
+MONTOS = ('subtotal', 'iva', 'iva_retenido', 'total')
+
+# Columnas que se solicitan a Supabase para construir el reporte
+COLUMNAS_DTE = ('fecha_emision', 'emisor_nit', 'emisor_nombre', 'tipo_dte', 'signo') + MONTOS
+
+# Margen (segundos) al comparar la hora de cálculo de la caché con updated_at de Supabase
+MARGEN_ACTUALIZACION = 5
+
+
+def _a_centavos(valor):
+    """
+    Convierte un monto (número o texto) a centavos enteros para sumar sin errores de redondeo.
+    """
+    if valor in (None, ''):
+        return 0
+    return int(round(float(valor) * 100))
+
+
+def _monto(resumen, *claves, default=0.0):
+    """
+    Retorna como número el primer campo del resumen que tenga valor.
+    """
+    for clave in claves:
+        if resumen.get(clave) is not None:
+            return float(resumen[clave])
+    return default
+
+
+def extract_dte_ledger(dict_data):
+    """
+    Extrae de un JSON de DTE los campos necesarios para el libro de compras:
+    tipo, fecha, emisor y los totales normalizados.
+    El subtotal siempre es el monto antes de IVA (en la Factura el subTotal ya incluye el IVA),
+    el IVA retenido va en su propia columna y las notas de crédito llevan signo negativo.
+    Las notas de remisión (04) no son compras gravadas: se cuentan pero sus montos quedan en cero.
+    """
+    identificacion = dict_data.get('identificacion') or {}
+    emisor = dict_data.get('emisor') or {}
+    resumen = dict_data.get('resumen') or {}
+    tipo = identificacion.get('tipoDte')
+
+    # IVA retenido: en el comprobante de retención es su único monto; en CCF y notas viene en ivaRete1
+    iva_retenido = 0.0 if tipo == '04' else _monto(resumen, 'totalIVAretenido', 'ivaRete1')
+
+    if tipo in TIPOS_SIN_MONTOS:
+        # Remisión y retención no son compras: no suman a subtotal, IVA ni total
+        subtotal = iva = total = 0.0
+    elif tipo in TIPOS_SIN_IVA:
+        iva = 0.0
+        subtotal = _monto(resumen, 'totalGravada', 'totalCompra', 'valorTotal', 'subTotal', 'montoTotalOperacion')
+        total = _monto(resumen, 'montoTotalOperacion', 'totalCompra', 'valorTotal', default=subtotal)
+    elif tipo == '01' or (resumen.get('totalIva') is not None and not resumen.get('tributos')):
+        # Factura de consumidor final: el subTotal y el total ya incluyen el IVA (totalIva)
+        iva = _monto(resumen, 'totalIva')
+        total = _monto(resumen, 'montoTotalOperacion', 'totalPagar')
+        subtotal = _monto(resumen, 'subTotal', 'subTotalVentas', default=total) - iva
+    else:
+        # CCF, notas de crédito/débito y demás: el subTotal es antes de IVA y el IVA es el tributo 20
+        subtotal = _monto(resumen, 'subTotal', 'subTotalVentas')
+        iva = sum(float(t.get('valor') or 0) for t in (resumen.get('tributos') or []) if t.get('codigo') == '20')
+        total = _monto(resumen, 'montoTotalOperacion', 'totalPagar', default=subtotal + iva)
+
+    return {
+        'tipo_dte': tipo,
+        'fecha_emision': identificacion.get('fecEmi'),
+        'emisor_nit': emisor.get('nit'),
+        'emisor_nombre': emisor.get('nombre'),
+        # Las notas de crédito restan en el reporte; los montos se guardan siempre positivos
+        'signo': -1 if tipo == '05' else 1,
+        'subtotal': round(subtotal, 2),
+        'iva': round(iva, 2),
+        'iva_retenido': round(iva_retenido, 2),
+        'total': round(total, 2)
+    }
+
+
+class LedgerReportService:
+    """
+    Servicio que resume los DTE descargados por un usuario en totales por mes, emisor y tipo de documento.
+    Los totales de cada mes se calculan una sola vez y se guardan en memoria. Antes de usar la caché se
+    consulta en Supabase si algún DTE del rango cambió (updated_at), así que una descarga atendida por
+    otro worker de gunicorn también invalida los meses afectados.
+    """
+    def __init__(self, supabase_service, cache_ttl_seconds=3600):
+        self.supabase = supabase_service
+        self.cache_ttl_seconds = cache_ttl_seconds
+        # Caché por (usuario, mes) -> (timestamp, {(emisor, tipo_dte): [conteo, subtotal, iva, iva_retenido, total]}, nombres)
+        self._cache = {}
+        self._last_sweep = time.time()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _months_between(start_month, end_month):
+        """
+        Genera la lista de meses (YYYY-MM) entre dos meses, ambos incluidos.
+        """
+        year, month = map(int, start_month.split('-'))
+        end_year, end_m = map(int, end_month.split('-'))
+        months = []
+        while (year, month) <= (end_year, end_m):
+            months.append(f"{year:04d}-{month:02d}")
+            month += 1
+            if month > 12:
+                year, month = year + 1, 1
+        return months
+
+    @staticmethod
+    def _date_range(months):
+        """
+        Retorna el rango de fechas [inicio, fin) que cubre la lista de meses (ordenada).
+        """
+        last_year, last_month = map(int, months[-1].split('-'))
+        end = date(last_year + last_month // 12, last_month % 12 + 1, 1).isoformat()
+        return f"{months[0]}-01", end
+
+    def invalidate(self, user_email, months):
+        """
+        Elimina de la caché los meses de un usuario que recibieron nuevos DTE.
+        """
+        with self._lock:
+            for month in months:
+                self._cache.pop((user_email, month), None)
+
+    def _get_cached(self, user_email, month, now):
+        """
+        Retorna la entrada de caché vigente de un mes, eliminando las que ya expiraron.
+        """
+        with self._lock:
+            # Barrido periódico para que no se acumulen entradas de usuarios que ya no consultan
+            if now - self._last_sweep >= self.cache_ttl_seconds:
+                expired = [k for k, v in self._cache.items() if now - v[0] >= self.cache_ttl_seconds]
+                for key in expired:
+                    del self._cache[key]
+                self._last_sweep = now
+
+            entry = self._cache.get((user_email, month))
+            if entry and now - entry[0] >= self.cache_ttl_seconds:
+                del self._cache[(user_email, month)]
+                return None
+            return entry
+
+    def _stale_months(self, user_email, cached):
+        """
+        Consulta en Supabase qué meses en caché tienen DTE guardados después de calcularse.
+        cached es un diccionario mes -> timestamp de cálculo.
+        """
+        months = sorted(cached)
+        start, end = self._date_range(months)
+        since = datetime.fromtimestamp(min(cached.values()) - MARGEN_ACTUALIZACION, tz=timezone.utc).isoformat()
+
+        stale = set()
+        for page in self.supabase.iter_dte_documents(user_email, start, end,
+                                                     columns=('fecha_emision', 'updated_at'), updated_since=since):
+            for row in page:
+                month = (row.get('fecha_emision') or '')[:7]
+                if month not in cached or month in stale:
+                    continue
+                updated = datetime.fromisoformat(row['updated_at'].replace('Z', '+00:00')).timestamp()
+                if updated > cached[month] - MARGEN_ACTUALIZACION:
+                    stale.add(month)
+        return stale
+
+    @staticmethod
+    def _aggregate_page(page, groups, names):
+        """
+        Acumula una página de DTE por (mes, emisor, tipo) sumando columna por columna.
+        Cada fila recibe un código entero de grupo y luego cada columna de montos se suma
+        sobre esos códigos (equivalente a un bincount), sin volver a recorrer filas completas.
+        """
+        codes_by_key = {}
+        codes = []
+        for row in page:
+            month = (row.get('fecha_emision') or '')[:7] or 'sin-fecha'
+            emisor = row.get('emisor_nit') or row.get('emisor_nombre') or 'Desconocido'
+            key = (month, emisor, row.get('tipo_dte') or '')
+            codes.append(codes_by_key.setdefault(key, len(codes_by_key)))
+            if row.get('emisor_nombre'):
+                names.setdefault(month, {})[emisor] = row['emisor_nombre']
+
+        signs = [-1 if row.get('signo') == -1 else 1 for row in page]
+        counts = [0] * len(codes_by_key)
+        for code in codes:
+            counts[code] += 1
+
+        sums_by_column = []
+        for column in MONTOS:
+            values = [sign * _a_centavos(row.get(column)) for sign, row in zip(signs, page)]
+            sums = [0] * len(codes_by_key)
+            for code, value in zip(codes, values):
+                sums[code] += value
+            sums_by_column.append(sums)
+
+        for (month, emisor, tipo), code in codes_by_key.items():
+            bucket = groups.setdefault(month, {}).setdefault((emisor, tipo), [0] * (len(MONTOS) + 1))
+            bucket[0] += counts[code]
+            for i, sums in enumerate(sums_by_column, start=1):
+                bucket[i] += sums[code]
+
+    def _load_months(self, user_email, months, now):
+        """
+        Consulta a Supabase los meses que no están en caché y calcula sus totales por páginas.
+        """
+        groups, names = {}, {}
+        start, end = self._date_range(months)
+
+        for page in self.supabase.iter_dte_documents(user_email, start, end, columns=COLUMNAS_DTE):
+            if page:
+                self._aggregate_page(page, groups, names)
+
+        # Los meses pedidos sin documentos también se guardan (vacíos) para no volver a consultarlos
+        with self._lock:
+            for month in months:
+                self._cache[(user_email, month)] = (now, groups.get(month, {}), names.get(month, {}))
+
+    def build_report(self, user_email, start_month, end_month, group_by=DIMENSIONES):
+        """
+        Construye las filas del reporte agrupadas por las dimensiones indicadas.
+        Retorna una lista de diccionarios ordenada por las columnas de agrupación.
+        """
+        now = time.time()
+        months = self._months_between(start_month, end_month)
+
+        cached = {}
+        for month in months:
+            entry = self._get_cached(user_email, month, now)
+            if entry:
+                cached[month] = entry[0]
+
+        # Los meses en caché que otro worker actualizó se vuelven a calcular
+        stale = self._stale_months(user_email, cached) if cached else set()
+
+        # Solo se consultan los meses sin caché vigente (en una sola consulta por rango)
+        missing = [m for m in months if m not in cached or m in stale]
+        if missing:
+            self._load_months(user_email, missing, now)
+
+        totals = {}
+        # Nombre más reciente de cada emisor (el NIT es la clave, el nombre puede variar entre meses)
+        emisor_names = {}
+        for month in months:
+            with self._lock:
+                _, month_groups, month_names = self._cache.get((user_email, month), (None, {}, {}))
+            emisor_names.update(month_names)
+            for (emisor, tipo), values in month_groups.items():
+                key_parts = {'mes': month, 'emisor': emisor, 'tipo_dte': tipo}
+                key = tuple(key_parts[d] for d in group_by)
+                bucket = totals.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    bucket[i] += value
+
+        rows = []
+        for key in sorted(totals):
+            count, *amounts = totals[key]
+            row = {}
+            for dimension, value in zip(group_by, key):
+                if dimension == 'emisor':
+                    row['emisor_nit'] = value
+                    row['emisor_nombre'] = emisor_names.get(value, '')
+                elif dimension == 'tipo_dte':
+                    row['tipo_dte'] = value
+                    row['tipo_documento'] = TIPOS_DTE.get(value, 'Desconocido')
+                else:
+                    row[dimension] = value
+            row['documentos'] = count
+            row.update({column: cents / 100 for column, cents in zip(MONTOS, amounts)})
+            rows.append(row)
+        return rows
+
+    @staticmethod
+    def _headers(group_by):
+        """
+        Determina el orden de las columnas del reporte según las dimensiones solicitadas.
+        """
+        headers = []
+        for dimension in group_by:
+            if dimension == 'emisor':
+                headers += ['emisor_nit', 'emisor_nombre']
+            elif dimension == 'tipo_dte':
+                headers += ['tipo_dte', 'tipo_documento']
+            else:
+                headers.append(dimension)
+        return headers + ['documentos'] + list(MONTOS)
+
+    def to_csv(self, rows, group_by=DIMENSIONES):
+        """
+        Genera el reporte en formato CSV (UTF-8 con BOM para que Excel muestre bien los acentos).
+        """
+        output = io.StringIO()
+        headers = self._headers(group_by)
+        writer = csv.DictWriter(output, fieldnames=headers)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({h: (f"{row[h]:.2f}" if h in MONTOS else row.get(h, ''))
+                             for h in headers})
+        return io.BytesIO(('\ufeff' + output.getvalue()).encode('utf-8'))
+
+    def to_xlsx(self, rows, group_by=DIMENSIONES):
+        """
+        Genera el reporte en formato XLSX utilizando openpyxl en modo de solo escritura.
+        """
+        from openpyxl import Workbook  # Importación local: solo se necesita al exportar a Excel
+
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet('Resumen DTE')
+        headers = self._headers(group_by)
+        sheet.append(headers)
+        for row in rows:
+            sheet.append([row.get(h, '') for h in headers])
+
+        output = io.BytesIO()
+        workbook.save(output)
+        output.seek(0)
+        return output
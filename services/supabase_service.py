@@ -1,6 +1,7 @@
 import os
 import requests
 import json
+from datetime import datetime, timezone
 
 class SupabaseService:
     def __init__(self):
@@ -94,3 +95,76 @@ class SupabaseService:
         except Exception as e:
             print(f"Connection error saving token: {str(e)}")
             return False
+
+    def save_dte_documents(self, dte_rows):
+        """
+        Guarda los datos contables extraídos de los JSON de DTE (emisor, tipo, fecha y totales).
+        Si el DTE ya existía para el usuario, se actualiza en lugar de duplicarse.
+        Cada fila lleva updated_at para que los reportes detecten cambios hechos desde otro worker.
+        """
+        if not self.url or not self.key:
+            return False
+
+        updated_at = datetime.now(timezone.utc).isoformat()
+        dte_rows = [{**row, "updated_at": updated_at} for row in dte_rows]
+
+        # Endpoint para la tabla de documentos DTE (clave única: usuario_email + codigo_generacion)
+        dte_url = f"{self.url}/rest/v1/dte_documentos?on_conflict=usuario_email,codigo_generacion"
+
+        headers = {
+            "apikey": self.key,
+            "Authorization": f"Bearer {self.key}",
+            "Content-Type": "application/json",
+            "Prefer": "resolution=merge-duplicates,return=minimal" # Upsert por código de generación
+        }
+
+        try:
+            response = requests.post(dte_url, headers=headers, data=json.dumps(dte_rows))
+            if response.status_code in [200, 201]:
+                return True
+            else:
+                print(f"Error saving DTE documents: {response.status_code} - {response.text}")
+                return False
+        except Exception as e:
+            print(f"Connection error saving DTE documents: {str(e)}")
+            return False
+
+    def iter_dte_documents(self, user_email, start_date, end_date, columns, updated_since=None, page_size=1000):
+        """
+        Recupera por páginas los DTE de un usuario con fecha de emisión en [start_date, end_date).
+        Solo se solicitan las columnas indicadas para reducir el tamaño de la respuesta.
+        Si se indica updated_since (ISO 8601), solo se devuelven los DTE guardados después de esa hora.
+        """
+        if not self.url or not self.key:
+            return
+
+        dte_url = f"{self.url}/rest/v1/dte_documentos"
+
+        headers = {
+            "apikey": self.key,
+            "Authorization": f"Bearer {self.key}",
+            "Content-Type": "application/json"
+        }
+
+        offset = 0
+        while True:
+            # PostgREST no admite dos filtros sobre la misma columna como parámetros repetidos en un dict
+            params = [
+                ("usuario_email", f"eq.{user_email}"),
+                ("fecha_emision", f"gte.{start_date}"),
+                ("fecha_emision", f"lt.{end_date}"),
+                ("select", ",".join(columns)),
+                ("order", "fecha_emision.asc,codigo_generacion.asc"),
+                *([("updated_at", f"gt.{updated_since}")] if updated_since else []),
+                ("limit", str(page_size)),
+                ("offset", str(offset))
+            ]
+            response = requests.get(dte_url, headers=headers, params=params)
+            if response.status_code != 200:
+                raise Exception(f"Error recuperando DTE: {response.status_code} - {response.text}")
+
+            page = response.json()
+            yield page
+            if len(page) < page_size:
+                return
+            offset += page_size
@@ -10,6 +10,8 @@ let selectedFiles = new Set();
 let currentResults = [];
 // Almacenar el email del usuario actual para el historial
 let currentUserEmail = '';
+// Límites de descarga informados por el servidor (bytes por ZIP y por usuario)
+let downloadLimits = null;
 
 // Selección de elementos del DOM para manipular la interfaz
 const loginScreen = document.getElementById('login-screen'); // Pantalla de inicio de sesión
@@ -20,6 +22,8 @@ const resultsList = document.getElementById('results-list'); // Contenedor de la
 const resultsCountLabel = document.getElementById('results-count'); // Etiqueta con el total de encontrados
 const actionBar = document.getElementById('action-bar');     // Barra de acciones para archivos seleccionados
 const selectedCountLabel = document.getElementById('selected-count'); // Etiqueta con el total de seleccionados
+const selectedSizeLabel = document.getElementById('selected-size'); // Etiqueta con el tamaño total seleccionado
+const selectedSizeWarning = document.getElementById('selected-size-warning'); // Aviso de descarga en varios volúmenes
 const selectionControls = document.getElementById('selection-controls'); // Controles de selección global
 const userEmailLabel = document.getElementById('user-email'); // Etiqueta para mostrar el email del usuario
 
@@ -160,6 +164,7 @@ async function simulateSearch() {
 
         if (response.ok) {
             currentResults = data.emails; // Guardar los correos encontrados
+            downloadLimits = data.limits || null; // Guardar los límites de descarga del servidor
             renderResults();             // Dibujar los resultados en pantalla
             if (currentResults.length === 0) {
                 // Mostrar mensaje si no hubo coincidencias
@@ -175,7 +180,10 @@ async function simulateSearch() {
                 lucide.createIcons();
             }
         } else {
-            showToast(data.error || "Error en la búsqueda", "error");
+            // Si el servidor está ocupado, indicar cuándo reintentar
+            const retryAfter = response.headers.get('Retry-After');
+            const retryText = response.status === 429 && retryAfter ? ` (reintenta en ${retryAfter} s)` : '';
+            showToast((data.error || "Error en la búsqueda") + retryText, "error");
             if (response.status === 401) logout(); // Desloguear si el token expiró
         }
     } catch (error) {
@@ -194,7 +202,8 @@ function renderResults() {
     }
 
     selectionControls.classList.remove('hidden'); // Mostrar controles de selección masiva
-    resultsCountLabel.innerText = `${currentResults.length} encontrados`;
+    const totalBytes = currentResults.reduce((sum, r) => sum + (r.size || 0), 0);
+    resultsCountLabel.innerText = `${currentResults.length} encontrados · ${formatBytes(totalBytes)}`;
     resultsList.innerHTML = '';
 
     currentResults.forEach(email => {
@@ -246,6 +255,7 @@ function renderResults() {
             </div>
             <div class="hidden sm:block text-right text-[10px] text-slate-400 font-bold ml-4">
                 ${email.attachments.length} adjunto(s)
+                <div class="font-medium">${formatBytes(email.size || 0)}</div>
             </div>
         `;
         resultsList.appendChild(item);
@@ -258,52 +268,129 @@ function renderResults() {
 
 /**
  * Agrupa los correos seleccionados y solicita al servidor la creación y descarga de un archivo ZIP.
+ * Si la selección supera el límite por descarga, se descarga en varios volúmenes propuestos por el servidor.
  */
 async function mockDownload() {
     // Filtrar la información completa de los correos seleccionados
     const selectedData = currentResults.filter(r => selectedFiles.has(r.id));
     if (selectedData.length === 0) return;
 
-    showToast(`Preparando ZIP con ${selectedData.length} facturas...`, "info");
+    const totalBytes = selectedData.reduce((sum, r) => sum + (r.size || 0), 0);
+    showToast(`Preparando ZIP con ${selectedData.length} facturas (${formatBytes(totalBytes)})...`, "info");
 
     try {
-        const response = await fetch('/api/download-batch', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ emails: selectedData })
-        });
+        const response = await requestZip(selectedData);
 
         if (response.ok) {
-            // --- NUEVO: EXTRAER METADATOS DTE DEL HEADER ---
-            // Se extrae el encabezado 'X-DTE-Metadata' que contiene información estructurada de los DTEs.
-            const dteMetadataHeader = response.headers.get('X-DTE-Metadata');
-            // Se parsea el JSON del encabezado; si no existe, se usa un array vacío.
-            const dteMetadata = dteMetadataHeader ? JSON.parse(dteMetadataHeader) : [];
-
-            // Recibir el archivo binario y forzar la descarga en el navegador
-            const blob = await response.blob();
-            const url = window.URL.createObjectURL(blob);
-            const link = document.createElement('a');
-            link.href = url;
-            link.download = 'facturas_descargadas.zip';
-            document.body.appendChild(link);
-            link.click();
-            link.remove();
-            window.URL.revokeObjectURL(url);
-
-            // --- NOTA: EL HISTORIAL AHORA SE GUARDA AUTOMÁTICAMENTE EN EL BACKEND ---
-
+            await saveFile(response, 'facturas_descargadas.zip');
             showToast("Descarga completada", "success");
             clearSelection(); // Limpiar la selección tras una descarga exitosa
+        } else if (response.status === 413) {
+            // La selección es demasiado grande: descargar los volúmenes uno por uno
+            const data = await response.json();
+            if (!data.volumes) {
+                showToast(data.error || "La selección es demasiado grande", "error");
+                return;
+            }
+            showToast(`Selección grande: se descargará en ${data.volumes.length} archivos ZIP`, "info");
+            for (const volume of data.volumes) {
+                const ids = new Set(volume.email_ids);
+                const volumeResponse = await requestZip(selectedData.filter(r => ids.has(r.id)));
+                if (!volumeResponse.ok) {
+                    await showDownloadError(volumeResponse);
+                    return;
+                }
+                await saveFile(volumeResponse, `facturas_${volume.label}.zip`);
+                showToast(`Volumen ${volume.index} de ${data.volumes.length} descargado`, "success");
+            }
+            clearSelection();
         } else {
-            showToast("Error al generar el ZIP", "error");
+            await showDownloadError(response);
         }
     } catch (error) {
         showToast("Error de conexión", "error");
     }
 }
 
+/**
+ * Envía al servidor la lista de correos a comprimir en un ZIP.
+ */
+function requestZip(emails) {
+    return fetch('/api/download-batch', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ emails: emails })
+    });
+}
+
+/**
+ * Recibe el archivo binario de la respuesta y fuerza la descarga en el navegador.
+ */
+async function saveFile(response, filename) {
+    // --- NUEVO: EXTRAER METADATOS DTE DEL HEADER ---
+    // Se extrae el encabezado 'X-DTE-Metadata' que contiene información estructurada de los DTEs.
+    const dteMetadataHeader = response.headers.get('X-DTE-Metadata');
+    // Se parsea el JSON del encabezado; si no existe, se usa un array vacío.
+    const dteMetadata = dteMetadataHeader ? JSON.parse(dteMetadataHeader) : [];
+
+    const blob = await response.blob();
+    const url = window.URL.createObjectURL(blob);
+    const link = document.createElement('a');
+    link.href = url;
+    link.download = filename;
+    document.body.appendChild(link);
+    link.click();
+    link.remove();
+    window.URL.revokeObjectURL(url);
+
+    // --- NOTA: EL HISTORIAL AHORA SE GUARDA AUTOMÁTICAMENTE EN EL BACKEND ---
+    return dteMetadata;
+}
 
+/**
+ * Muestra el error devuelto por el servidor al generar un ZIP, incluyendo el tiempo de espera si aplica.
+ */
+async function showDownloadError(response) {
+    let message = "Error al generar el ZIP";
+    try {
+        const data = await response.json();
+        message = data.error || message;
+    } catch (e) { /* La respuesta no era JSON */ }
+
+    const retryAfter = response.headers.get('Retry-After');
+    if (response.status === 429 && retryAfter) {
+        const seconds = Number(retryAfter);
+        message += seconds >= 60 ? ` (reintenta en ${Math.ceil(seconds / 60)} min)` : ` (reintenta en ${seconds} s)`;
+    }
+    showToast(message, "error");
+}
+
+// --- LÓGICA DE REPORTES ---
+
+/**
+ * Descarga el reporte contable (totales por mes, emisor y tipo de DTE) del rango de fechas seleccionado.
+ * Si no hay fechas, se usa el mes actual.
+ */
+async function downloadLedgerReport(format) {
+    const currentMonth = new Date().toISOString().slice(0, 7);
+    const startMonth = (document.getElementById('start-date').value || '').slice(0, 7) || currentMonth;
+    const endMonth = (document.getElementById('end-date').value || '').slice(0, 7) || startMonth;
+
+    showToast(`Generando reporte ${startMonth} a ${endMonth}...`, "info");
+
+    try {
+        const params = new URLSearchParams({ start: startMonth, end: endMonth, format: format });
+        const response = await fetch(`/api/reports/ledger?${params}`);
+        if (!response.ok) {
+            await showDownloadError(response);
+            return;
+        }
+        await saveFile(response, `reporte_dte_${startMonth}_${endMonth}.${format}`);
+        showToast("Reporte generado", "success");
+    } catch (error) {
+        showToast("Error de conexión", "error");
+    }
+}
 
 // --- AYUDAS DE INTERFAZ DE USUARIO ---
 
@@ -342,6 +429,26 @@ function updateActionBar() {
     if (!actionBar || !selectedCountLabel) return;
     actionBar.classList.toggle('hidden', selectedFiles.size === 0);
     selectedCountLabel.innerText = selectedFiles.size;
+
+    // Mostrar el tamaño total de la selección y avisar si se dividirá en varios ZIP
+    const selectedBytes = currentResults
+        .filter(r => selectedFiles.has(r.id))
+        .reduce((sum, r) => sum + (r.size || 0), 0);
+    if (selectedSizeLabel) selectedSizeLabel.innerText = formatBytes(selectedBytes);
+    if (selectedSizeWarning) {
+        const overLimit = downloadLimits && selectedBytes > downloadLimits.max_request_bytes;
+        selectedSizeWarning.classList.toggle('hidden', !overLimit);
+    }
+}
+
+/**
+ * Convierte una cantidad de bytes a un texto legible (KB, MB, GB).
+ */
+function formatBytes(bytes) {
+    if (!bytes) return '0 B';
+    const units = ['B', 'KB', 'MB', 'GB'];
+    const i = Math.min(Math.floor(Math.log(bytes) / Math.log(1024)), units.length - 1);
+    return `${(bytes / Math.pow(1024, i)).toFixed(i === 0 ? 0 : 1)} ${units[i]}`;
 }
 
 /**